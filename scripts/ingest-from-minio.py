@@ -2,65 +2,310 @@
 """
 Ingest documents from MinIO to doc-ingest-service
 """
+import asyncio
+import ipaddress
+import itertools
+import json
 import os
+import queue
 import sys
+import threading
+import time
 import boto3
 import requests
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+from urllib.parse import urlparse
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from botocore.client import Config
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+
+# Repository root, used to import the service's ingest pipeline for in-process runs
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Objects larger than this are downloaded as parallel byte-range GETs,
+# since a single connection tops out well below the link bandwidth
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+RANGE_WORKERS = 8
+
+# Serializes output from worker threads so progress lines don't interleave
+PRINT_LOCK = threading.Lock()
+
+# Minimum keep-alive connections kept per host for ingest POSTs
+HTTP_POOL_SIZE = 64
+
+# Ingest responses that are retried, with exponential backoff between attempts.
+# urllib3 won't retry POSTs on status, and a consumed multipart stream can't
+# be replayed, so ingest_document retries by rebuilding the request body.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POST_ATTEMPTS = 4
+POST_BACKOFF = 0.5
+
+# Shared HTTP session so every worker reuses pooled keep-alive connections
+# instead of paying a TCP/TLS handshake per document
+SESSION = requests.Session()
+
+def configure_session(session: requests.Session, pool_size: int = HTTP_POOL_SIZE):
+    """Mount a pooled adapter sized for pool_size concurrent requests"""
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        # Retries connection failures, which happen before the body is sent
+        max_retries=Retry(total=3, backoff_factor=0.5)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+configure_session(SESSION)
+
+def log(message: str):
+    """Print a line without interleaving with other worker threads"""
+    with PRINT_LOCK:
+        print(message)
 
-def get_minio_client(endpoint: str, access_key: str, secret_key: str):
+def get_minio_client(endpoint: str, access_key: str, secret_key: str, max_pool_connections: int = 10):
     """Create MinIO/S3 client"""
     return boto3.client(
         's3',
         endpoint_url=endpoint,
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-        config=Config(signature_version='s3v4'),
+        config=Config(
+            signature_version='s3v4',
+            max_pool_connections=max_pool_connections,
+            # Adaptive mode retries throttling and transient errors with
+            # exponential backoff and rate-limits the client when throttled
+            retries={'mode': 'adaptive', 'max_attempts': 10},
+            connect_timeout=5,
+            read_timeout=60
+        ),
         verify=False  # Set to True in production with proper certs
     )
 
-def list_documents(client, bucket: str, prefix: str = "data/") -> List[str]:
-    """List all documents in MinIO bucket"""
-    print(f"\n📂 Listing documents in bucket '{bucket}' with prefix '{prefix}'...")
+def list_documents(client, bucket: str, prefix: str = "data/") -> Iterator[Tuple[str, str]]:
+    """
+    Yield (key, etag) for documents in MinIO bucket
 
-    try:
-        response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    Pages through list_objects_v2, so buckets with more than 1000 objects are
+    fully listed and ingestion can start as soon as the first page arrives.
+    """
+    print(f"\n📂 Listing documents in bucket '{bucket}' with prefix '{prefix}'...")
 
-        if 'Contents' not in response:
-            print(f"⚠️  No files found in {bucket}/{prefix}")
-            return []
+    paginator = client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=bucket,
+        Prefix=prefix,
+        PaginationConfig={'PageSize': 1000}
+    )
 
-        files = []
-        for obj in response['Contents']:
+    for page in pages:
+        for obj in page.get('Contents', []):
             key = obj['Key']
             # Skip directories
             if not key.endswith('/'):
-                files.append(key)
+                yield key, obj['ETag']
+
+class BufferReader:
+    """
+    Read-only file-like view over an in-memory buffer that doesn't copy it
+
+    Reports the bytes left to read as `len`, which MultipartEncoder needs
+    to stream a part.
+    """
+
+    def __init__(self, buffer: Union[bytes, bytearray]):
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    @property
+    def len(self) -> int:
+        return len(self._view) - self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+
+def _fetch_range(client, bucket: str, key: str, etag: str, view: memoryview, start: int, end: int):
+    """Download bytes [start, end] of an object into its slot in the buffer"""
+    part = client.get_object(
+        Bucket=bucket,
+        Key=key,
+        Range=f"bytes={start}-{end}",
+        IfMatch=etag  # Fail rather than mix parts if the object changes mid-download
+    )
+    view[start:end + 1] = part['Body'].read()
+
+def download_document(client, bucket: str, key: str) -> Union[bytes, bytearray]:
+    """Download an object, splitting large objects into parallel range GETs"""
+    obj = client.get_object(Bucket=bucket, Key=key)
+    size = obj['ContentLength']
+
+    if size <= MULTIPART_THRESHOLD:
+        return obj['Body'].read()
+
+    # Assemble parts in place in a preallocated buffer. The first part is
+    # read from the GET that is already open, the rest are fetched by range.
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    first_end = min(MULTIPART_CHUNKSIZE, size)
+
+    with ThreadPoolExecutor(max_workers=RANGE_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                _fetch_range, client, bucket, key, obj['ETag'], view,
+                start, min(start + MULTIPART_CHUNKSIZE, size) - 1
+            )
+            for start in range(MULTIPART_CHUNKSIZE, size, MULTIPART_CHUNKSIZE)
+        ]
+
+        try:
+            view[:first_end] = obj['Body'].read(first_end)
+        finally:
+            obj['Body'].close()
+
+        for future in futures:
+            future.result()
+
+    return buffer
+
+def is_loopback_url(url: str) -> bool:
+    """Check whether a URL points at this host"""
+    host = urlparse(url).hostname or ''
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
 
-        print(f"✅ Found {len(files)} files")
-        return files
+def load_ingest_core():
+    """Import the service's ingest pipeline from this checkout"""
+    sys.path.insert(0, str(REPO_ROOT))
+    from src import ingest_core
+    return ingest_core
+
+class _LoopThread:
+    """Event loop in a background thread that worker threads submit coroutines to"""
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+class LocalIngester(_LoopThread):
+    """
+    Runs the service's ingest pipeline in-process instead of over HTTP
+
+    The asyncpg pool lives on an event loop in a background thread; worker
+    threads submit documents to it and wait for the result.
+    """
+
+    def __init__(self, ingest_core, pool_size: int):
+        super().__init__()
+        self.core = ingest_core
+        try:
+            self._pool = self._run(ingest_core.create_pool(min_size=1, max_size=pool_size))
+        except Exception:
+            self._stop_loop()
+            raise
+
+    def ingest(self, filename: str, content: bytes, metadata: Dict[str, Any]) -> int:
+        """Ingest an uploaded file the same way the /ingest endpoint does"""
+        if not filename.endswith(self.core.SUPPORTED_EXTENSIONS):
+            raise ValueError(f"Unsupported file type: {filename}")
+
+        text = content.decode('utf-8', errors='replace')
+        metadata = dict(metadata, filename=filename)
+        return self._run(self.core.ingest_text(self._pool, text, filename, metadata))
+
+    def close(self):
+        self._run(self._pool.close())
+        self.core.shutdown_chunk_pool()
+        self._stop_loop()
+
+class IngestedIndex(_LoopThread):
+    """
+    Answers which documents are already in the database
+
+    Needs only asyncpg and the POSTGRES_* environment, so --skip-existing
+    works without the service's pipeline code.
+    """
+
+    def __init__(self):
+        super().__init__()
+        import asyncpg
+
+        settings = {
+            'host': os.getenv('POSTGRES_HOST', 'localhost'),
+            'port': int(os.getenv('POSTGRES_PORT', '5432')),
+            'user': os.getenv('POSTGRES_USER', 'raguser'),
+            'database': os.getenv('POSTGRES_DB', 'ragdb'),
+        }
+        self.dsn = "{user}@{host}:{port}/{database}".format(**settings)
+        try:
+            self._conn = self._run(asyncpg.connect(
+                password=os.getenv('POSTGRES_PASSWORD', 'ragpassword'),
+                timeout=10,
+                **settings
+            ))
+        except Exception:
+            self._stop_loop()
+            raise
+
+    def current_keys(self, bucket: str, files: List[Tuple[str, str]]) -> Set[str]:
+        """Return the keys whose listed ETag (or an untracked version) is stored"""
+        return self._run(self._fetch_current_keys(bucket, files))
+
+    async def _fetch_current_keys(self, bucket: str, files: List[Tuple[str, str]]) -> Set[str]:
+        # Containment matches are served by the GIN index on metadata. A key
+        # is current if any stored version matches, or predates ETag tracking.
+        patterns = [json.dumps({"bucket": bucket, "original_path": key}) for key, _ in files]
+        rows = await self._conn.fetch(
+            """
+            SELECT metadata->>'original_path' AS key
+            FROM document_chunks
+            WHERE metadata @> ANY($1::jsonb[])
+            GROUP BY 1
+            HAVING bool_or(
+                metadata->>'etag' IS NULL
+                OR metadata->>'etag' = $2::jsonb->>(metadata->>'original_path')
+            )
+            """,
+            patterns,
+            json.dumps(dict(files))
+        )
+        return {row['key'] for row in rows}
 
-    except Exception as e:
-        print(f"❌ Error listing files: {e}")
-        return []
+    def close(self):
+        self._run(self._conn.close())
+        self._stop_loop()
 
 def ingest_document(
-    client,
+    session: requests.Session,
     bucket: str,
     key: str,
-    ingest_url: str
+    etag: str,
+    content: Union[bytes, bytearray],
+    ingest_url: str,
+    local: Optional[LocalIngester] = None
 ) -> bool:
-    """Download document from MinIO and ingest to doc-ingest-service"""
+    """Ingest a downloaded document to doc-ingest-service"""
 
     try:
-        # Download from MinIO
-        print(f"\n📥 Processing: {key}")
-        obj = client.get_object(Bucket=bucket, Key=key)
-        content = obj['Body'].read()
-
         # Get filename
         filename = Path(key).name
 
@@ -68,32 +313,72 @@ def ingest_document(
         metadata = {
             "source": "minio",
             "bucket": bucket,
-            "original_path": key
+            "original_path": key,
+            "etag": etag
         }
 
-        # Post to doc-ingest-service
-        files = {'file': (filename, content)}
-        data = {'metadata': str(metadata).replace("'", '"')}
+        if local is not None:
+            chunks_created = local.ingest(filename, content, metadata)
+            log(f"   ✅ {key}: {chunks_created} chunks")
+            return True
 
-        response = requests.post(
-            ingest_url,
-            files=files,
-            data=data,
-            verify=False  # Set to True in production
-        )
+        for attempt in range(POST_ATTEMPTS):
+            if attempt:
+                time.sleep(POST_BACKOFF * 2 ** (attempt - 1))
+
+            # Post to doc-ingest-service, streaming the body from the downloaded
+            # buffer so the multipart encoder doesn't make a second copy of it.
+            # The encoder is rebuilt per attempt since it can't be rewound.
+            encoder = MultipartEncoder(fields={
+                'metadata': json.dumps(metadata),
+                'file': (filename, BufferReader(content), 'application/octet-stream')
+            })
+
+            response = session.post(
+                ingest_url,
+                data=encoder,
+                headers={'Content-Type': encoder.content_type},
+                timeout=(5, 120),
+                verify=False  # Set to True in production
+            )
+
+            if response.status_code not in RETRY_STATUSES:
+                break
 
         if response.status_code == 200:
             result = response.json()
-            print(f"   ✅ Ingested: {result.get('chunks_created', 0)} chunks")
+            log(f"   ✅ {key}: {result.get('chunks_created', 0)} chunks")
             return True
         else:
-            print(f"   ❌ Failed: {response.status_code} - {response.text}")
+            log(f"   ❌ {key}: {response.status_code} - {response.text}")
             return False
 
     except Exception as e:
-        print(f"   ❌ Error: {e}")
+        log(f"   ❌ {key}: {e}")
         return False
 
+def skip_ingested(
+    files: Iterator[Tuple[str, str]],
+    index: IngestedIndex,
+    bucket: str,
+    skipped: List[str],
+    batch_size: int = 1000
+) -> Iterator[Tuple[str, str]]:
+    """
+    Drop documents whose current version is already in the database
+
+    Keys are checked in batches of one query each. A key is skipped if it was
+    stored with the same ETag, or before ETags were recorded. Skipped keys
+    are appended to `skipped`.
+    """
+    for batch in iter(lambda: list(itertools.islice(files, batch_size)), []):
+        current = index.current_keys(bucket, batch)
+        for key, etag in batch:
+            if key in current:
+                skipped.append(key)
+            else:
+                yield key, etag
+
 def main():
     parser = argparse.ArgumentParser(
         description='Ingest documents from MinIO to doc-ingest-service',
@@ -105,6 +390,15 @@ Environment Variables:
   MINIO_SECRET_KEY   MinIO secret key
   MINIO_BUCKET       MinIO bucket name (default: kb-documents)
   MINIO_PREFIX       Path prefix in bucket (default: data/)
+  POSTGRES_*         Database settings for in-process ingestion and
+                     --skip-existing (see README)
+
+When --ingest-url points at localhost and this script runs from a checkout of
+the service, documents are ingested in-process (no HTTP hop) using the
+service's pipeline code. Settings come from THIS script's environment, not the
+service's: POSTGRES_* picks the database (defaulting to localhost/ragdb) and
+CHUNK_SIZE/CHUNK_OVERLAP the chunking. If localhost is a port-forward to a
+remote service, or its settings differ, use --force-http.
 
 Examples:
   # Using environment variables
@@ -162,8 +456,42 @@ Examples:
         type=int,
         help='Limit number of files to process'
     )
+    parser.add_argument(
+        '--skip-existing',
+        action='store_true',
+        help='Skip documents already ingested with the same ETag (needs POSTGRES_* access)'
+    )
+    parser.add_argument(
+        '--force-http',
+        action='store_true',
+        help='Always POST to --ingest-url, even when it is on localhost. In-process '
+             'mode uses this shell\'s POSTGRES_* and CHUNK_* settings, not the service\'s'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=16,
+        help='Number of documents to ingest in parallel (default: 16)'
+    )
+    parser.add_argument(
+        '--download-workers',
+        type=int,
+        help='Threads downloading from MinIO (default: --concurrency)'
+    )
+    parser.add_argument(
+        '--upload-workers',
+        type=int,
+        help='Threads posting to the ingest service (default: --concurrency)'
+    )
 
     args = parser.parse_args()
+    for option in ('concurrency', 'download_workers', 'upload_workers'):
+        value = getattr(args, option)
+        if value is not None and value < 1:
+            parser.error(f"--{option.replace('_', '-')} must be at least 1")
+
+    download_workers = args.concurrency if args.download_workers is None else args.download_workers
+    upload_workers = args.concurrency if args.upload_workers is None else args.upload_workers
 
     # Validate required parameters
     if not args.minio_endpoint:
@@ -188,36 +516,88 @@ Examples:
     print(f"Bucket: {args.bucket}")
     print(f"Prefix: {args.prefix}")
     print(f"Ingest URL: {args.ingest_url}")
+    print(f"Workers: {download_workers} download / {upload_workers} upload")
+    print(f"Skip Existing: {args.skip_existing}")
     print(f"Dry Run: {args.dry_run}")
 
+    # Size both connection pools to the worker count. botocore defaults to
+    # 10 connections, so extra workers would otherwise open and discard a
+    # fresh connection per request instead of reusing one.
+    configure_session(SESSION, max(HTTP_POOL_SIZE, upload_workers))
+
     # Create MinIO client
     try:
         client = get_minio_client(
             args.minio_endpoint,
             args.access_key,
-            args.secret_key
+            args.secret_key,
+            # A large download holds its first GET open while RANGE_WORKERS
+            # range GETs run, so each download worker can use that many
+            max_pool_connections=download_workers * (RANGE_WORKERS + 1)
         )
     except Exception as e:
         print(f"❌ Failed to connect to MinIO: {e}")
         sys.exit(1)
 
-    # List documents
+    # Ingest in-process when the service is local and its code is available
+    local = None
+    if is_loopback_url(args.ingest_url) and not args.force_http and not args.dry_run:
+        try:
+            local = LocalIngester(load_ingest_core(), pool_size=upload_workers)
+        except Exception as e:
+            print(f"⚠️  In-process ingestion unavailable ({e}), using HTTP")
+
+    if local is not None:
+        core = local.core
+        print("\n🔗 Ingest URL is local - ingesting in-process, bypassing HTTP")
+        print(f"   Database: {core.DB_USER}@{core.DB_HOST}:{core.DB_PORT}/{core.DB_NAME}")
+        print(f"   Chunking: size {core.CHUNK_SIZE}, overlap {core.CHUNK_OVERLAP}")
+        print("   (from this shell's POSTGRES_*/CHUNK_* env; use --force-http to post instead)")
+
+    # --skip-existing reads the database directly, even when posting over HTTP
+    index = None
+    if args.skip_existing:
+        try:
+            index = IngestedIndex()
+        except Exception as e:
+            print(f"❌ Error: --skip-existing needs database access (POSTGRES_* env): {e}")
+            if local is not None:
+                local.close()
+            sys.exit(1)
+        print(f"\n⏭️  Skipping documents already ingested in {index.dsn}")
+
+    # List documents lazily, page by page
     files = list_documents(client, args.bucket, args.prefix)
 
-    if not files:
-        print("\n⚠️  No files to process")
-        sys.exit(0)
+    # Drop documents that are already ingested and unchanged
+    skipped = []
+    if index is not None:
+        files = skip_ingested(files, index, args.bucket, skipped)
 
     # Apply limit if specified
     if args.limit:
-        files = files[:args.limit]
+        files = itertools.islice(files, args.limit)
         print(f"\n📌 Limited to {args.limit} files")
 
     if args.dry_run:
         print("\n🔍 Dry run - files found:")
-        for f in files:
-            print(f"   - {f}")
-        print("\n✅ Dry run complete")
+        total = 0
+        try:
+            for f, _ in files:
+                print(f"   - {f}")
+                total += 1
+        except Exception as e:
+            print(f"❌ Error listing files: {e}")
+            sys.exit(1)
+        finally:
+            if index is not None:
+                index.close()
+
+        if skipped:
+            print(f"\n⏭️  Skipped {len(skipped)} already-ingested files")
+        if total == 0:
+            print("\n⚠️  No files to process")
+        print(f"\n✅ Dry run complete ({total} files)")
         sys.exit(0)
 
     # Ingest documents
@@ -225,27 +605,97 @@ Examples:
     print("📤 Starting ingestion...")
     print("=" * 70)
 
+    total = 0
     success_count = 0
     fail_count = 0
-
-    for idx, key in enumerate(files, 1):
-        print(f"\n[{idx}/{len(files)}]", end=" ")
-
-        if ingest_document(client, args.bucket, key, args.ingest_url):
-            success_count += 1
-        else:
-            fail_count += 1
+    list_failed = False
+
+    def record(ok: bool):
+        nonlocal success_count, fail_count
+        with PRINT_LOCK:
+            if ok:
+                success_count += 1
+            else:
+                fail_count += 1
+            done_count = success_count + fail_count
+            print(f"[{done_count}/{total}] ✅ {success_count} ❌ {fail_count}")
+
+    # Downloads and uploads run as two stages joined by a bounded queue, so
+    # the next documents are fetched from MinIO while earlier ones are being
+    # posted. The queue bound caps how many downloaded documents wait in memory.
+    prefetched = queue.Queue(maxsize=2 * upload_workers)
+
+    def download(key: str, etag: str):
+        try:
+            content = download_document(client, args.bucket, key)
+        except Exception as e:
+            log(f"   ❌ {key}: {e}")
+            record(False)
+            return
+        prefetched.put((key, etag, content))
+
+    def upload_loop():
+        while True:
+            item = prefetched.get()
+            if item is None:
+                return
+            key, etag, content = item
+            record(ingest_document(SESSION, args.bucket, key, etag, content, args.ingest_url, local))
+
+    uploaders = [
+        threading.Thread(target=upload_loop, daemon=True)
+        for _ in range(upload_workers)
+    ]
+    for uploader in uploaders:
+        uploader.start()
+
+    # Bound the number of queued downloads so a huge listing doesn't pile
+    # up in the executor ahead of the workers
+    slots = threading.BoundedSemaphore(download_workers * 2)
+
+    # boto3 clients and requests sessions are safe to share across threads,
+    # so all workers reuse the same connection pools. Keys are submitted as
+    # pages arrive, overlapping the listing with GET/POST work.
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+        try:
+            for key, etag in files:
+                slots.acquire()
+                with PRINT_LOCK:
+                    total += 1
+                future = downloads.submit(download, key, etag)
+                future.add_done_callback(lambda _: slots.release())
+        except Exception as e:
+            log(f"❌ Error listing files: {e}")
+            list_failed = True
+
+    # All downloads are queued; tell each uploader to stop once drained
+    for _ in uploaders:
+        prefetched.put(None)
+    for uploader in uploaders:
+        uploader.join()
+
+    for db in (local, index):
+        if db is not None:
+            db.close()
+
+    if skipped:
+        print(f"\n⏭️  Skipped {len(skipped)} already-ingested files")
+
+    if total == 0 and not list_failed:
+        print("\n⚠️  No files to process")
+        sys.exit(0)
 
     # Summary
     print("\n" + "=" * 70)
     print("📊 Ingestion Summary")
     print("=" * 70)
-    print(f"Total files: {len(files)}")
+    print(f"Total files: {total}")
+    print(f"⏭️  Skipped: {len(skipped)}")
     print(f"✅ Successful: {success_count}")
     print(f"❌ Failed: {fail_count}")
     print("=" * 70)
 
-    if fail_count > 0:
+    if fail_count > 0 or list_failed:
         sys.exit(1)
 
     print("\n✅ Ingestion complete!")
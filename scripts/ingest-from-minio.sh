@@ -65,9 +65,9 @@ fi
 
 # Check for Python dependencies
 echo "Checking Python dependencies..."
-if ! python3 -c "import boto3, requests" 2>/dev/null; then
+if ! python3 -c "import boto3, requests, requests_toolbelt, asyncpg" 2>/dev/null; then
     echo "⚠️  Missing dependencies. Installing..."
-    pip3 install --user boto3 requests urllib3
+    pip3 install --user boto3 requests requests-toolbelt urllib3 asyncpg
 fi
 
 echo "✅ Dependencies ready"
@@ -46,13 +46,35 @@ oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
 CREATE TABLE IF NOT EXISTS document_chunks (
     id SERIAL PRIMARY KEY,
     text TEXT NOT NULL,
-    text_search tsvector NOT NULL,
+    text_search tsvector GENERATED ALWAYS AS (to_tsvector('english', text)) STORED,
     document_uri TEXT NOT NULL,
     chunk_num INTEGER NOT NULL,
     metadata JSONB DEFAULT '{}'::jsonb,
     created_at TIMESTAMP DEFAULT NOW()
 );" >/dev/null 2>&1
 
+# Migrate tables created by older versions of this script, where text_search
+# was a plain column filled in by a trigger, to the generated column
+oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
+DO \$\$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'document_chunks'
+          AND column_name = 'text_search'
+          AND is_generated = 'NEVER'
+    ) THEN
+        DROP TRIGGER IF EXISTS tsvector_update ON document_chunks;
+        ALTER TABLE document_chunks DROP COLUMN text_search;
+        ALTER TABLE document_chunks
+            ADD COLUMN text_search tsvector GENERATED ALWAYS AS (to_tsvector('english', text)) STORED;
+    END IF;
+END
+\$\$;" >/dev/null 2>&1
+
+oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
+DROP FUNCTION IF EXISTS document_chunks_tsvector_update();" >/dev/null 2>&1
+
 # Create GIN index for full-text search
 oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
 CREATE INDEX IF NOT EXISTS idx_text_search_gin ON document_chunks USING GIN(text_search);" >/dev/null 2>&1
@@ -65,25 +87,6 @@ CREATE INDEX IF NOT EXISTS idx_document_uri ON document_chunks(document_uri);" >
 oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
 CREATE INDEX IF NOT EXISTS idx_metadata_gin ON document_chunks USING GIN(metadata);" >/dev/null 2>&1
 
-# Create function for tsvector auto-update
-oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
-CREATE OR REPLACE FUNCTION document_chunks_tsvector_update() RETURNS trigger AS \$\$
-BEGIN
-    NEW.text_search := to_tsvector('english', NEW.text);
-    RETURN NEW;
-END;
-\$\$ LANGUAGE plpgsql;" >/dev/null 2>&1
-
-# Drop trigger if exists
-oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
-DROP TRIGGER IF EXISTS tsvector_update ON document_chunks;" >/dev/null 2>&1
-
-# Create trigger
-oc exec "$POD_NAME" -n "$NAMESPACE" -- psql -U raguser -d ragdb -c "
-CREATE TRIGGER tsvector_update BEFORE INSERT OR UPDATE
-ON document_chunks FOR EACH ROW
-EXECUTE FUNCTION document_chunks_tsvector_update();" >/dev/null 2>&1
-
 if [ $? -eq 0 ]; then
     echo "✅ Schema created successfully"
 else
@@ -0,0 +1,327 @@
+"""
+Core ingestion pipeline shared by the HTTP service and local pipelines
+Cleans, chunks and stores documents in PostgreSQL for full-text search
+"""
+import os
+import re
+import mmap
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+import asyncpg
+import orjson
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+logger = logging.getLogger(__name__)
+
+# Configuration from environment
+DB_HOST = os.getenv("POSTGRES_HOST", "localhost")
+DB_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+DB_USER = os.getenv("POSTGRES_USER", "raguser")
+DB_PASSWORD = os.getenv("POSTGRES_PASSWORD", "ragpassword")
+DB_NAME = os.getenv("POSTGRES_DB", "ragdb")
+
+# Connection pool size
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "4"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "32"))
+
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "800"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "150"))
+
+# Chunking runs in worker processes so large documents don't block the event
+# loop. Documents longer than CHUNK_SHARD_SIZE characters are split on
+# paragraph boundaries into shards that are chunked in parallel.
+# Each worker is a full interpreter, so the default is capped; in containers
+# set CHUNK_WORKERS to match the pod's CPU limit.
+MAX_DEFAULT_CHUNK_WORKERS = 4
+
+
+def _default_chunk_workers() -> int:
+    """CPUs this process may run on, capped at MAX_DEFAULT_CHUNK_WORKERS"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        cpus = os.cpu_count() or 1
+    return max(1, min(cpus, MAX_DEFAULT_CHUNK_WORKERS))
+
+
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS") or _default_chunk_workers())
+CHUNK_SHARD_SIZE = int(os.getenv("CHUNK_SHARD_SIZE", str(256 * 1024)))
+
+# Documents with at least this many chunks are inserted with COPY
+COPY_THRESHOLD = int(os.getenv("COPY_THRESHOLD", "64"))
+
+# Supported uploaded file types
+# TODO: Add Docling for PDF/DOCX processing
+SUPPORTED_EXTENSIONS = ('.md', '.txt', '.html')
+
+# Null bytes and other control characters, except \t, \n and \r
+_CONTROL_CHARS_RE = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
+
+# Built once and reused; each chunking worker process gets its own copy on import
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    length_function=len,
+    is_separator_regex=False,
+)
+
+_chunk_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_chunk_pool() -> ProcessPoolExecutor:
+    """Return the chunking worker pool, creating it on first use"""
+    global _chunk_pool
+    if _chunk_pool is None:
+        # Worker processes are spawned rather than forked from a threaded parent
+        _chunk_pool = ProcessPoolExecutor(
+            max_workers=CHUNK_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _chunk_pool
+
+
+def _discard_chunk_pool(pool: ProcessPoolExecutor):
+    """Drop a broken worker pool so the next call starts a fresh one"""
+    global _chunk_pool
+    if _chunk_pool is pool:
+        _chunk_pool = None
+        pool.shutdown(wait=False)
+
+
+def shutdown_chunk_pool():
+    """Stop the chunking worker processes"""
+    global _chunk_pool
+    if _chunk_pool is not None:
+        _chunk_pool.shutdown()
+        _chunk_pool = None
+
+
+async def create_pool(
+    min_size: int = DB_POOL_MIN_SIZE,
+    max_size: int = DB_POOL_MAX_SIZE
+) -> asyncpg.Pool:
+    """Create a connection pool for the configured database"""
+    return await asyncpg.create_pool(
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=1024,
+        # Fail fast when PostgreSQL is unreachable instead of asyncpg's 60s
+        timeout=5
+    )
+
+
+def clean_text(text: str) -> str:
+    """
+    Clean text to handle encoding issues and PostgreSQL constraints
+    - Remove null bytes (0x00) which PostgreSQL TEXT cannot store
+    - Remove other control characters except newlines, tabs, and carriage returns
+    - Ensure valid UTF-8 encoding
+    """
+    # Drop lone surrogates that can't be encoded, then strip control characters
+    text = text.encode('utf-8', errors='ignore').decode('utf-8')
+    return _CONTROL_CHARS_RE.sub('', text)
+
+
+def _split_text(text: str) -> List[str]:
+    """Split text with RecursiveCharacterTextSplitter (runs in a worker process)"""
+    return _SPLITTER.split_text(text)
+
+
+def _overlap_tail(shard: str, overlap: int) -> str:
+    """
+    Text from the end of a shard to repeat at the start of the next one
+
+    The splitter carries whole trailing paragraphs over a paragraph break, up
+    to overlap characters. When the last paragraph alone is longer than that,
+    its last overlap characters are used instead, starting at a word.
+    """
+    paragraphs = shard.split("\n\n")
+    keep = []
+    total = 0
+    for paragraph in reversed(paragraphs):
+        total += len(paragraph) + (2 if keep else 0)
+        if total > overlap:
+            break
+        keep.append(paragraph)
+
+    if keep:
+        return "\n\n".join(reversed(keep))
+
+    tail = shard[-overlap:] if overlap else ""
+    return tail[tail.find(" ") + 1:]
+
+
+def _shard_text(text: str, shard_size: int, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """
+    Split text into shards of roughly shard_size characters
+
+    Shards end on paragraph breaks, which the splitter treats as its first
+    separator anyway. Each shard after the first starts with the tail of the
+    one before it, so chunks still overlap across shard boundaries. Chunks
+    near a boundary can differ from splitting the whole text in one pass.
+    """
+    shards = []
+    start = 0
+
+    while len(text) - start > shard_size:
+        cut = text.rfind("\n\n", start, start + shard_size)
+        if cut <= start:
+            cut = text.find("\n\n", start + shard_size)
+        if cut == -1:
+            break
+        shards.append(text[start:cut])
+        start = cut + 2
+
+    shards.append(text[start:])
+
+    return [shards[0]] + [
+        f"{_overlap_tail(previous, overlap)}\n\n{shard}"
+        for previous, shard in zip(shards, shards[1:])
+    ]
+
+
+def read_text_file(path: Path) -> str:
+    """
+    Read a local file as UTF-8 text via a memory map
+
+    Decoding straight from the mapped pages avoids holding a bytes copy of
+    the file alongside the decoded string.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = str(mm, 'utf-8', 'replace')
+
+    # Match read_text's universal newline handling
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    return text
+
+
+async def _split_shards(shards: List[str]) -> List[List[str]]:
+    """Split each shard in the worker pool, discarding the pool if it broke"""
+    loop = asyncio.get_running_loop()
+    pool = _get_chunk_pool()
+
+    try:
+        return await asyncio.gather(*[
+            loop.run_in_executor(pool, _split_text, shard)
+            for shard in shards
+        ])
+    except BrokenProcessPool:
+        _discard_chunk_pool(pool)
+        raise
+
+
+async def chunk_text(text: str) -> List[Dict[str, Any]]:
+    """Chunk text using RecursiveCharacterTextSplitter in the worker pool"""
+    shards = _shard_text(text, CHUNK_SHARD_SIZE)
+
+    try:
+        shard_chunks = await _split_shards(shards)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed), which breaks the whole pool.
+        # Retry once on a fresh pool rather than failing every later request.
+        logger.warning("Chunking worker pool broke, restarting it")
+        shard_chunks = await _split_shards(shards)
+
+    chunks = []
+    for shard in shard_chunks:
+        # Drop a leading chunk made only of the carried-over overlap
+        if chunks and shard and chunks[-1].endswith(shard[0]):
+            shard = shard[1:]
+        chunks.extend(shard)
+
+    return [
+        {"text": chunk, "chunk_num": idx}
+        for idx, chunk in enumerate(chunks)
+    ]
+
+
+async def insert_chunks(
+    conn: asyncpg.Connection,
+    chunks: List[Dict[str, Any]],
+    document_uri: str,
+    metadata: Dict[str, Any]
+) -> int:
+    """
+    Insert chunks for full-text search
+
+    All chunks of a document are written in one batch inside a single
+    transaction, so either the whole document is stored or none of it.
+    Large documents are bulk-loaded with COPY. When the metadata names a
+    source object (bucket and original_path), chunks from its previous
+    version are deleted in the same transaction so re-ingesting replaces it.
+    """
+    # Convert metadata dict to JSON string (shared by every chunk)
+    metadata_json = orjson.dumps(metadata).decode()
+
+    rows = [
+        (chunk["text"], document_uri, chunk["chunk_num"], metadata_json)
+        for chunk in chunks
+    ]
+
+    source = {
+        key: metadata[key] for key in ("bucket", "original_path") if key in metadata
+    }
+
+    # text_search is a generated column, so PostgreSQL builds the tsvector
+    async with conn.transaction():
+        if len(source) == 2:
+            # Containment match is served by the GIN index on metadata
+            await conn.execute(
+                "DELETE FROM document_chunks WHERE metadata @> $1::jsonb",
+                orjson.dumps(source).decode()
+            )
+
+        if len(rows) >= COPY_THRESHOLD:
+            await conn.copy_records_to_table(
+                "document_chunks",
+                records=rows,
+                columns=["text", "document_uri", "chunk_num", "metadata"]
+            )
+        elif rows:
+            await conn.executemany(
+                """
+                INSERT INTO document_chunks (text, document_uri, chunk_num, metadata)
+                VALUES ($1, $2, $3, $4::jsonb)
+                """,
+                rows
+            )
+
+    logger.info(f"Inserted {len(rows)} chunks for {document_uri}")
+    return len(rows)
+
+
+async def ingest_text(
+    pool: asyncpg.Pool,
+    text: str,
+    document_uri: str,
+    metadata: Dict[str, Any]
+) -> int:
+    """Clean, chunk and store a document, returning the number of chunks inserted"""
+    # Clean text to remove null bytes and handle encoding issues
+    text = clean_text(text)
+
+    logger.info(f"Processing document: {document_uri} ({len(text)} chars)")
+
+    # Chunk the text
+    chunks = await chunk_text(text)
+    logger.info(f"Created {len(chunks)} chunks")
+
+    # Insert chunks (tsvector is generated by PostgreSQL)
+    async with pool.acquire() as conn:
+        return await insert_chunks(conn, chunks, document_uri, metadata)
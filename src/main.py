@@ -3,36 +3,75 @@ Simple Document Ingestion Service
 Processes documents and stores them with PostgreSQL tsvector for full-text search (TF-IDF style)
 """
 import os
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import List, Dict, Any
-import asyncpg
+import orjson
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from src.ingest_core import (
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    SUPPORTED_EXTENSIONS,
+    create_pool,
+    ingest_text,
+    read_text_file,
+    shutdown_chunk_pool,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum documents processed concurrently by /ingest/batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+
+async def get_pool():
+    """
+    Return the database connection pool, creating it if needed
+
+    The service starts even when PostgreSQL is down; the pool is then
+    created by the first request that finds the database reachable.
+    """
+    if app.state.pool is None:
+        async with app.state.pool_lock:
+            if app.state.pool is None:
+                app.state.pool = await create_pool()
+                logger.info(f"Database pool ready ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} connections)")
+    return app.state.pool
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the database connection pool on startup and close it on shutdown"""
+    app.state.pool = None
+    app.state.pool_lock = asyncio.Lock()
+
+    try:
+        await get_pool()
+    except Exception as e:
+        logger.error(f"Database unavailable at startup, will retry on demand: {e}")
+
+    try:
+        yield
+    finally:
+        if app.state.pool is not None:
+            await app.state.pool.close()
+        shutdown_chunk_pool()
+
+
 app = FastAPI(
     title="Document Ingestion Service",
     description="Service for ingesting documents with PostgreSQL full-text search (tsvector)",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
-# Configuration from environment
-DB_HOST = os.getenv("POSTGRES_HOST", "localhost")
-DB_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
-DB_USER = os.getenv("POSTGRES_USER", "raguser")
-DB_PASSWORD = os.getenv("POSTGRES_PASSWORD", "ragpassword")
-DB_NAME = os.getenv("POSTGRES_DB", "ragdb")
-
-CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "800"))
-CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "150"))
-
-
 class IngestResponse(BaseModel):
     success: bool
     document_uri: str
@@ -40,96 +79,14 @@ class IngestResponse(BaseModel):
     message: str
 
 
-def clean_text(text: str) -> str:
-    """
-    Clean text to handle encoding issues and PostgreSQL constraints
-    - Remove null bytes (0x00) which PostgreSQL TEXT cannot store
-    - Replace other problematic characters
-    - Ensure valid UTF-8 encoding
-    """
-    # Remove null bytes
-    text = text.replace('\x00', '')
-
-    # Remove other control characters except newlines, tabs, and carriage returns
-    import re
-    text = re.sub(r'[\x01-\x08\x0B\x0C\x0E-\x1F\x7F]', '', text)
-
-    # Ensure valid UTF-8 by encoding and decoding with error handling
-    text = text.encode('utf-8', errors='ignore').decode('utf-8')
-
-    return text
-
-
-async def chunk_text(text: str) -> List[Dict[str, Any]]:
-    """Chunk text using RecursiveCharacterTextSplitter"""
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        length_function=len,
-        is_separator_regex=False,
-    )
-
-    chunks = splitter.split_text(text)
-
-    return [
-        {"text": chunk, "chunk_num": idx}
-        for idx, chunk in enumerate(chunks)
-    ]
-
-
-async def insert_chunks(
-    conn: asyncpg.Connection,
-    chunks: List[Dict[str, Any]],
-    document_uri: str,
-    metadata: Dict[str, Any]
-) -> int:
-    """Insert chunks with tsvector for full-text search"""
-    import json
-
-    total_inserted = 0
-
-    for chunk in chunks:
-        try:
-            # Convert metadata dict to JSON string
-            metadata_json = json.dumps(metadata)
-
-            # Insert chunk with tsvector generated automatically by PostgreSQL
-            await conn.execute(
-                """
-                INSERT INTO document_chunks (text, text_search, document_uri, chunk_num, metadata)
-                VALUES ($1, to_tsvector('english', $1), $2, $3, $4::jsonb)
-                """,
-                chunk["text"],
-                document_uri,
-                chunk["chunk_num"],
-                metadata_json
-            )
-            total_inserted += 1
-            logger.info(f"Inserted chunk {chunk['chunk_num']} for {document_uri}")
-
-        except Exception as e:
-            logger.error(f"Failed to insert chunk {chunk['chunk_num']}: {e}")
-            # Continue with other chunks even if one fails
-            continue
-
-    return total_inserted
-
-
 @app.get("/health")
 async def health():
     """Health check endpoint"""
     # Test database connection
     try:
-        conn = await asyncpg.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME,
-            timeout=5.0
-        )
-        await conn.execute("SELECT 1")
-        await conn.close()
+        pool = await asyncio.wait_for(get_pool(), timeout=5.0)
+        async with pool.acquire(timeout=5.0) as conn:
+            await conn.execute("SELECT 1")
         db_status = "connected"
     except Exception as e:
         logger.error(f"Database health check failed: {e}")
@@ -157,26 +114,23 @@ async def ingest_document(
     - document_uri: URI/path to process
     - text_content: Direct text content
     """
-    import json
-
     if not any([file, document_uri, text_content]):
         raise HTTPException(400, "Must provide file, document_uri, or text_content")
 
     try:
-        metadata_dict = json.loads(metadata)
+        metadata_dict = orjson.loads(metadata)
     except:
         metadata_dict = {}
 
     # Get text content
     if text_content:
-        text = clean_text(text_content)
+        text = text_content
         uri = document_uri or "direct_input"
     elif file:
         content = await file.read()
 
         # Support text files (MD, TXT, HTML)
-        # TODO: Add Docling for PDF/DOCX processing
-        if file.filename.endswith(('.md', '.txt', '.html')):
+        if file.filename.endswith(SUPPORTED_EXTENSIONS):
             text = content.decode('utf-8', errors='replace')
         else:
             raise HTTPException(400, f"Unsupported file type: {file.filename}")
@@ -190,30 +144,11 @@ async def ingest_document(
         if not path.exists():
             raise HTTPException(404, f"File not found: {document_uri}")
 
-        text = path.read_text(encoding='utf-8', errors='replace')
+        text = read_text_file(path)
         uri = document_uri
 
-    # Clean text to remove null bytes and handle encoding issues
-    text = clean_text(text)
-
-    logger.info(f"Processing document: {uri} ({len(text)} chars)")
-
-    # Chunk the text
-    chunks = await chunk_text(text)
-    logger.info(f"Created {len(chunks)} chunks")
-
-    # Connect to database
-    conn = await asyncpg.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME
-    )
-
     try:
-        # Insert chunks with tsvector
-        chunks_inserted = await insert_chunks(conn, chunks, uri, metadata_dict)
+        chunks_inserted = await ingest_text(await get_pool(), text, uri, metadata_dict)
 
         return IngestResponse(
             success=True,
@@ -226,26 +161,32 @@ async def ingest_document(
         logger.error(f"Ingestion failed: {e}")
         raise HTTPException(500, f"Ingestion failed: {str(e)}")
 
-    finally:
-        await conn.close()
-
 
 @app.post("/ingest/batch")
 async def ingest_batch(document_uris: List[str]):
     """
     Ingest multiple documents (for pipeline use)
-    Processes one at a time
+    Processes up to BATCH_CONCURRENCY documents at a time
     """
-    results = []
-
-    for uri in document_uris:
-        try:
-            # Call single ingest for each
-            result = await ingest_document(document_uri=uri, metadata="{}")
-            results.append({"uri": uri, "success": True, "chunks": result.chunks_created})
-        except Exception as e:
-            logger.error(f"Failed to ingest {uri}: {e}")
-            results.append({"uri": uri, "success": False, "error": str(e)})
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def _one(uri: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                # Call single ingest for each. Unused form parameters are passed
+                # explicitly since their FastAPI defaults only apply to requests.
+                result = await ingest_document(
+                    file=None,
+                    document_uri=uri,
+                    text_content=None,
+                    metadata="{}"
+                )
+                return {"uri": uri, "success": True, "chunks": result.chunks_created}
+            except Exception as e:
+                logger.error(f"Failed to ingest {uri}: {e}")
+                return {"uri": uri, "success": False, "error": str(e)}
+
+    results = await asyncio.gather(*[_one(uri) for uri in document_uris])
 
     success_count = sum(1 for r in results if r["success"])
 
@@ -257,6 +198,8 @@ async def ingest_batch(document_uris: List[str]):
     }
 
 
+# Run from the repository root as a module (python -m src.main), since
+# src.ingest_core is imported by package path
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)